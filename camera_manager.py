@@ -3,24 +3,166 @@ ToupCamera Manager Module
 Thread-safe camera management for FastAPI web streaming
 Supports dual resolution: fast streaming + high-resolution still capture
 """
+import os
+import asyncio
 import threading
+import queue
 import io
 import time
+import ctypes
+import itertools
+import functools
+import numpy as np
 import toupcam
 from PIL import Image
-from typing import Optional, Dict, Any, Callable
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Dict, Any, Callable, List
+
+# None of the heavy calls hold the GIL: toupcam.py loads the SDK through ctypes.cdll/windll,
+# which releases it for every foreign call (PullImageV4, Snap, ...), PyTurboJPEG is ctypes too,
+# and OpenCV/Pillow release it while encoding. The SDK callback thread, the encoder thread and
+# the web server's event loop can therefore run on separate cores.
+
+# libjpeg-turbo (SIMD) encoder, falls back to OpenCV, then Pillow when not installed
+try:
+    from turbojpeg import (TurboJPEG, TJPF_BGR, TJPF_GRAY, TJSAMP_420, TJSAMP_444, TJSAMP_GRAY,
+                           TJFLAG_FASTDCT, TJFLAG_ACCURATEDCT)
+    _tj = TurboJPEG()  # Loads the shared library once for every encode
+except (ImportError, OSError, RuntimeError):
+    _tj = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Optional GPU encoder (nvJPEG through torchvision), opt in with TOUPCAM_USE_NVJPEG=1
+_nvjpeg = False
+if os.environ.get("TOUPCAM_USE_NVJPEG") == "1":
+    try:
+        import torch
+        from torchvision.io import encode_jpeg as _nv_encode_jpeg
+        _nvjpeg = torch.cuda.is_available()
+    except (ImportError, OSError, RuntimeError):
+        pass  # Not installed, or a broken CUDA/torch install (e.g. "DLL load failed")
+_nv_lock = threading.Lock()
+_nv_staging: Dict[tuple, Any] = {}  # Pinned host tensors by frame shape, for async H2D copies
+
+# Have the SDK deliver pixels in the encoder's native order so no channel swap is needed:
+# BGR for TurboJPEG/OpenCV, RGB for Pillow (TOUPCAM_OPTION_BYTEORDER: 0 => RGB, 1 => BGR)
+_BYTEORDER_BGR = 1 if (_tj is not None or cv2 is not None) else 0
+
+
+def _stream_max_dim_from_env(default: int = 1920) -> int:
+    """Longest streamed side from TOUPCAM_STREAM_MAX_DIM (0 = no downscale), default when unusable"""
+    value = os.environ.get("TOUPCAM_STREAM_MAX_DIM")
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        print(f"[Camera] Ignoring TOUPCAM_STREAM_MAX_DIM={value!r}, using {default}")
+        return default
+
+
+def _encode_nvjpeg(pixels: np.ndarray, quality: int) -> bytes:
+    """Encode on the GPU with nvJPEG: copy into pinned memory, upload, encode, download the bitstream"""
+    with _nv_lock:
+        staging = _nv_staging.get(pixels.shape)
+        if staging is None:
+            staging = _nv_staging[pixels.shape] = torch.empty(pixels.shape, dtype=torch.uint8).pin_memory()
+        np.copyto(staging.numpy(), pixels)  # Also drops any row padding
+        image = staging.to("cuda", non_blocking=True).permute(2, 0, 1)
+        if _BYTEORDER_BGR:
+            image = image.flip(0)  # nvJPEG wants RGB
+        return _nv_encode_jpeg(image, quality=quality).cpu().numpy().tobytes()
+
+
+def _encode_fast(pixels: np.ndarray, quality: int, still: bool = False) -> Optional[bytes]:
+    """Encode a packed BGR (or 1-channel grey) array with nvJPEG, TurboJPEG or OpenCV, None if none is available
+
+    Streaming frames use 4:2:0 chroma and the fast DCT; stills keep full 4:4:4 chroma and the accurate DCT.
+    """
+    global _nvjpeg
+    # torchvision's GPU encoder has no chroma subsampling or DCT options and only
+    # takes 3-channel input, so stills (4:4:4, accurate DCT) and mono frames stay on the CPU
+    if _nvjpeg and not still and pixels.shape[2] == 3:
+        try:
+            return _encode_nvjpeg(pixels, quality)
+        except RuntimeError as e:
+            # e.g. a torchvision build without GPU encode support: stay on the CPU from now on
+            print(f"[Camera] nvJPEG encode failed, using CPU encoder: {e}")
+            _nvjpeg = False
+    if _tj is not None:
+        flags = TJFLAG_ACCURATEDCT if still else TJFLAG_FASTDCT
+        if pixels.shape[2] == 1:
+            return _tj.encode(pixels, quality=quality, pixel_format=TJPF_GRAY, jpeg_subsample=TJSAMP_GRAY,
+                              flags=flags)
+        return _tj.encode(pixels, quality=quality, pixel_format=TJPF_BGR,
+                          jpeg_subsample=TJSAMP_444 if still else TJSAMP_420, flags=flags)
+    if cv2 is not None:
+        # OpenCV releases the GIL while compressing
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+        if still and hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+        ok, jpg = cv2.imencode('.jpg', pixels, params)
+        if ok:
+            return jpg.tobytes()
+    return None
+
+
+def _encode_jpeg(pixels: np.ndarray, quality: int, buffer: io.BytesIO, still: bool = False,
+                 **pil_options) -> bytes:
+    """Encode a packed frame once with the fastest available encoder (Pillow as last resort)"""
+    jpeg_bytes = _encode_fast(pixels, quality, still)
+    if jpeg_bytes is not None:
+        return jpeg_bytes
+    
+    height, width, channels = pixels.shape
+    mode = 'RGB' if channels == 3 else 'L'
+    image = Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
+    buffer.seek(0)
+    buffer.truncate()
+    image.save(buffer, format='JPEG', quality=quality, **pil_options)
+    return buffer.getvalue()
 
 
 class ToupCameraManager:
     """Thread-safe manager for ToupCamera devices with dual resolution support"""
     
+    IDLE_ENCODE_INTERVAL = 1.0  # Seconds between encodes while nobody is streaming
+    STILL_QUALITY = 95  # Stills: 4:4:4 chroma, accurate DCT
+    STREAM_TARGET_FPS = 30  # Encode budget used to tune the streaming JPEG quality
+    STREAM_QUALITY_MIN = 20
+    STREAM_QUALITY_MAX = 60
+    STREAM_QUALITY_STEP = 5
+    QUALITY_LOWER_FRAMES = 10  # Consecutive over-budget frames before lowering quality
+    QUALITY_RAISE_FRAMES = 60  # Consecutive fast frames before raising it again
+    
     def __init__(self):
         self.hcam = None
         self.cur = None
+        # Control calls (Snap, Stop/Start, put_*) from the web/serial threads run here, one at a time
+        self._cam_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="camera")
         self.img_width = 0
         self.img_height = 0
-        self.pData = None
+        self.bits = 24  # Pixel depth pulled from the SDK (8 = grey on mono sensors)
+        self.bytes_per_pixel = 3
+        self._bufs: list = []  # Double-buffered raw frames (poll fills one, encoder reads the other)
+        self._free_bufs: queue.Queue = queue.Queue()  # Buffer indices ready to be filled
+        self._enc_q: queue.Queue = queue.Queue(maxsize=1)  # Filled buffer indices awaiting encode
+        self._buf_views: list = []  # (height, width, bpp) numpy views over _bufs, padding skipped by strides
+        self._row_stride = 0  # Cached per resolution: bytes per SDK row, incl. padding
+        self._row_bytes = 0  # Cached per resolution: bytes of pixel data per row
+        self._has_padding = False
+        # Larger frames are downscaled before the stream encode; TOUPCAM_STREAM_MAX_DIM=0 turns it off
+        self._stream_max_dim = _stream_max_dim_from_env() or None
+        self._scale_factor = 1  # Cached per resolution: integer downscale factor for streaming
+        self._stream_scaled: Optional[np.ndarray] = None  # Reused downscaled frame
+        self._rgb_packed: Optional[np.ndarray] = None  # Reused packed RGB frame
+        self._rgb_store: Optional[np.ndarray] = None  # Backing memory for _rgb_packed
+        self._scaled_store: Optional[np.ndarray] = None  # Backing memory for _stream_scaled
+        self._jpeg_io = io.BytesIO()  # Reused JPEG output buffer (Pillow path)
         self.res = 0  # Current streaming resolution index
         self.snap_res = 0  # Capture resolution index (highest by default)
         self.temp = toupcam.TOUPCAM_TEMP_DEF
@@ -28,22 +170,54 @@ class ToupCameraManager:
         self.frame_count = 0
         self.fps = 0.0
         self.capture_count = 0
+        self._capture_seq = itertools.count(1)  # Numbers default capture filenames
+        self.dropped_frames = 0  # Frames discarded because the encoder fell behind
+        
+        # Per-open SDK data that doesn't change under us: built once, dropped when it does
+        self._cached_resolutions: Optional[list] = None
+        self._cached_still_resolutions: Optional[list] = None
+        self._exp_bounds: Optional[tuple] = None  # (min, max, default) exposure time
+        self._gain_bounds: Optional[tuple] = None  # (min, max, default) analog gain
+        
+        # Streaming quality (4:2:0, fast DCT), tuned from the measured encode time
+        # unless pinned with set_stream_quality()
+        self.stream_quality = 35
+        self.adaptive_quality = True
+        self._encode_ema = 0.0  # Smoothed encode time in seconds
+        self._quality_streak = 0  # Consecutive frames pushing quality the same way
         
-        # Thread safety
-        self._frame_lock = threading.Lock()
-        self._current_frame: Optional[bytes] = None  # JPEG bytes for streaming
-        self._frame_available = threading.Event()
+        # Thread safety: the newest JPEG frame is published by swapping one reference (no lock needed)
+        self._current_frame: Optional[bytes] = None
         
-        # Polling thread
+        # Async streaming clients, only touched on the web server's loop:
+        # each subscriber queue holds that client's next frame
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: set = set()
+        
+        # Streaming consumers: frames are only encoded while someone is watching
+        self._consumer_lock = threading.Lock()
+        self._consumers = 0
+        self._last_idle_encode = 0.0
+        
+        # Frames arrive via SDK callbacks; encoding runs on its own thread
         self._running = False
-        self._poll_thread: Optional[threading.Thread] = None
+        self._encode_thread: Optional[threading.Thread] = None
+        self._fps_time = 0.0
+        self._fps_frames = 0
         
         # Still image capture
         self._still_lock = threading.Lock()
-        self._still_image: Optional[bytes] = None  # High-res JPEG
-        self._still_requested = False
+        self._still_image: Optional[bytes] = None  # Full-frame JPEG (cameras without Snap)
         self._still_complete = threading.Event()
-        self._still_filename: Optional[str] = None
+        self._still_size = (0, 0)  # Width/height of _still_image
+        self._still_pulled: Optional[tuple] = None  # (width, height) of the raw still in _still_pData
+        self._still_gen = 0  # Numbers Snap requests
+        self._still_wanted: Optional[int] = None  # Generation waiting for its still, None while none is
+        self.last_capture_size = (0, 0)  # Width/height of the last successful capture
+        self._full_frame_requested = False  # No-still cameras: encode the next frame at full size
+        self._still_pData = None  # Raw still buffer, sized once for the largest still resolution
+        self._still_rgb: Optional[np.ndarray] = None  # Reused packed RGB still
+        self._still_io = io.BytesIO()  # Reused JPEG output buffer (Pillow path)
         
         # Callbacks for external notifications
         self._on_error: Optional[Callable[[str], None]] = None
@@ -61,6 +235,8 @@ class ToupCameraManager:
         """Get available still/capture resolutions (usually higher than preview)"""
         if not self.cur:
             return []
+        if self._cached_still_resolutions is not None:
+            return self._cached_still_resolutions
         
         still_count = self.cur.model.still
         resolutions = []
@@ -84,6 +260,7 @@ class ToupCameraManager:
                     "current": i == self.snap_res
                 })
         
+        self._cached_still_resolutions = resolutions
         return resolutions
     
     def open_camera(self, camera_id: Optional[str] = None) -> bool:
@@ -142,24 +319,36 @@ class ToupCameraManager:
         print(f"[Camera] Stream resolution: {self.img_width}x{self.img_height} (index {self.res})")
         print(f"[Camera] Still resolutions available: {still_count}")
         
-        # Allocate buffer
-        self.pData = bytes(toupcam.TDIBWIDTHBYTES(self.img_width * 24) * self.img_height)
+        # Mono sensors deliver 8-bit grey instead of RGB24: a third of the bytes per frame
+        if self.cur.model.flag & toupcam.TOUPCAM_FLAG_MONO:
+            self.hcam.put_Option(toupcam.TOUPCAM_OPTION_RGB, 3)
+            self.bits = 8
+        else:
+            self.bits = 24
+        self.bytes_per_pixel = self.bits // 8
+        
+        # Allocate buffers
+        self._alloc_stream_buffers()
+        if still_count > 0:
+            still_sizes = [toupcam.TDIBWIDTHBYTES(r.width * self.bits) * r.height
+                           for r in self.cur.model.res[:still_count]]
+            self._still_pData = ctypes.create_string_buffer(max(still_sizes))
         
         # Configure camera
-        self.hcam.put_Option(toupcam.TOUPCAM_OPTION_BYTEORDER, 0)  # RGB byte order
+        self.hcam.put_Option(toupcam.TOUPCAM_OPTION_BYTEORDER, _BYTEORDER_BGR)  # Encoder's native byte order
         self.hcam.put_eSize(self.res)  # Set streaming resolution
         
-        # Start pull mode WITHOUT callback (we'll poll manually)
+        # Start pull mode with the SDK event callback (no polling)
         try:
-            self.hcam.StartPullModeWithCallback(None, None)
+            self._start_threads()
+            self.hcam.StartPullModeWithCallback(self._event_callback, self)
             self.hcam.put_AutoExpoEnable(1)
             
-            # Start polling thread
-            self._running = True
-            self._poll_thread = threading.Thread(target=self._poll_frames, daemon=True)
-            self._poll_thread.start()
+            # Warm the caches so the first /settings request doesn't pay for them
+            self.get_resolutions()
+            self.get_still_resolutions()
             
-            print("[Camera] Started successfully with polling thread")
+            print("[Camera] Started successfully in callback mode")
             return True
         except toupcam.HRESULTException as e:
             print(f"[Camera] Failed to start: {e}")
@@ -169,186 +358,439 @@ class ToupCameraManager:
     def close_camera(self):
         """Close the camera and clean up resources"""
         self._running = False
-        
-        if self._poll_thread:
-            self._poll_thread.join(timeout=2.0)
-            self._poll_thread = None
-        
         if self.hcam:
             self.hcam.Close()
+        self._stop_threads()
         self.hcam = None
         self.cur = None
-        self.pData = None
-        with self._frame_lock:
-            self._current_frame = None
+        self._cached_resolutions = None
+        self._cached_still_resolutions = None
+        self._exp_bounds = None
+        self._gain_bounds = None
+        self._bufs = []
+        self._buf_views = []
+        self._rgb_packed = None
+        self._stream_scaled = None
+        self._rgb_store = None
+        self._scaled_store = None
+        self._still_rgb = None
+        self._still_pData = None
+        self._current_frame = None
         with self._still_lock:
             self._still_image = None
+            self._still_wanted = None
     
-    def _poll_frames(self):
-        """Background thread that polls for frames"""
-        print("[Camera] Polling thread started")
-        last_fps_time = time.time()
-        frame_count_for_fps = 0
+    def _alloc_stream_buffers(self):
+        """Allocate the raw frame double buffer and the packing/downscale arrays once for all preview resolutions"""
+        # Every later resolution fits in these, so set_resolution() never reallocates
+        bpp = self.bytes_per_pixel
+        max_size = packed_pixels = scaled_pixels = 0
+        for r in self.cur.model.res[:self.cur.model.preview]:
+            stride = toupcam.TDIBWIDTHBYTES(r.width * self.bits)
+            max_size = max(max_size, stride * r.height)
+            # Packing copies are only needed where rows carry padding, and the
+            # downscaled frame never exceeds _stream_max_dim
+            if stride != r.width * bpp:
+                packed_pixels = max(packed_pixels, r.width * r.height * bpp)
+            f = self._stream_scale(r.width, r.height)
+            if f > 1:
+                scaled_pixels = max(scaled_pixels, (r.width // f) * (r.height // f) * bpp)
         
-        while self._running and self.hcam:
+        # Mutable ctypes buffers so numpy can view them without copying
+        self._bufs = [ctypes.create_string_buffer(max_size) for _ in range(2)]
+        self._rgb_store = np.empty(packed_pixels, dtype=np.uint8) if packed_pixels else None
+        self._scaled_store = np.empty(scaled_pixels, dtype=np.uint8) if scaled_pixels else None
+        self._free_bufs = queue.Queue()
+        for i in range(len(self._bufs)):
+            self._free_bufs.put(i)
+        self._enc_q = queue.Queue(maxsize=1)
+        self._layout_stream_buffers()
+    
+    def _layout_stream_buffers(self):
+        """Build the numpy views over the preallocated buffers for the current resolution"""
+        # Row layout only changes with the resolution, so work it out once here
+        self._row_stride = toupcam.TDIBWIDTHBYTES(self.img_width * self.bits)
+        self._row_bytes = self.img_width * self.bytes_per_pixel
+        self._has_padding = self._row_stride != self._row_bytes
+        
+        shape = (self.img_height, self.img_width, self.bytes_per_pixel)
+        strides = (self._row_stride, self.bytes_per_pixel, 1)
+        self._buf_views = [np.ndarray(shape, dtype=np.uint8, buffer=b, strides=strides) for b in self._bufs]
+        self._rgb_packed = (self._rgb_store[:self._row_bytes * self.img_height].reshape(shape)
+                            if self._has_padding else None)
+        
+        self._scale_factor = self._stream_scale(self.img_width, self.img_height)
+        if self._scale_factor > 1:
+            scaled_shape = (self.img_height // self._scale_factor, self.img_width // self._scale_factor,
+                            self.bytes_per_pixel)
+            self._stream_scaled = self._scaled_store[:int(np.prod(scaled_shape))].reshape(scaled_shape)
+        else:
+            self._stream_scaled = None
+    
+    def _stream_scale(self, width: int, height: int) -> int:
+        """Integer downscale factor that brings a frame within _stream_max_dim pixels for streaming"""
+        longest = max(width, height)
+        if self._stream_max_dim and longest > self._stream_max_dim:
+            return -(-longest // self._stream_max_dim)
+        return 1
+    
+    def _reclaim_buffers(self, timeout: float = 2.0) -> List[int]:
+        """Take every frame buffer back from the encoder once no more frames are arriving"""
+        held = []
+        deadline = time.time() + timeout
+        while len(held) < len(self._bufs) and time.time() < deadline:
             try:
-                # Wait for a frame (50ms timeout)
-                self.hcam.WaitImageV4(50, self.pData, 0, 24, 0, None)
-                
-                # Process the frame for streaming
-                self._process_frame()
-                
-                # Calculate FPS
-                frame_count_for_fps += 1
-                now = time.time()
-                if now - last_fps_time >= 1.0:
-                    self.fps = frame_count_for_fps / (now - last_fps_time)
-                    self.frame_count += frame_count_for_fps
-                    frame_count_for_fps = 0
-                    last_fps_time = now
+                held.append(self._enc_q.get_nowait())
+            except queue.Empty:
+                try:
+                    held.append(self._free_bufs.get(timeout=0.05))
+                except queue.Empty:
+                    pass
+        return held
+    
+    def _start_threads(self):
+        """Start the encoding thread and accept frames from the SDK callback"""
+        self._fps_time = time.time()
+        self._fps_frames = 0
+        self._last_idle_encode = 0.0  # Always encode the first frame after a (re)start
+        self._encode_ema = 0.0
+        self._quality_streak = 0
+        self._running = True
+        self._encode_thread = threading.Thread(target=self._encode_frames, daemon=True)
+        self._encode_thread.start()
+    
+    def _stop_threads(self):
+        """Stop accepting frames and stop the encoding thread"""
+        self._running = False
+        
+        if self._encode_thread:
+            self._encode_thread.join(timeout=2.0)
+            self._encode_thread = None
+    
+    @staticmethod
+    def _event_callback(nEvent, self):
+        """SDK event callback, runs on the SDK's own thread (ctx is the manager)"""
+        self._on_event(nEvent)
+    
+    def _on_event(self, nEvent):
+        """Dispatch an SDK event"""
+        if not self._running:
+            return
+        
+        if nEvent == toupcam.TOUPCAM_EVENT_IMAGE:
+            self._pull_frame()
+        elif nEvent == toupcam.TOUPCAM_EVENT_STILLIMAGE:
+            self._try_pull_still_image()
+        elif nEvent in (toupcam.TOUPCAM_EVENT_ERROR, toupcam.TOUPCAM_EVENT_DISCONNECTED):
+            print(f"[Camera] Camera error event: {nEvent:#x}")
+    
+    def _pull_frame(self):
+        """Pull the live frame that just arrived and hand it to the encoder"""
+        # Take a free buffer; if the encoder is behind, reclaim the frame still
+        # waiting to be encoded (drop oldest) so the SDK thread never stalls on it
+        try:
+            idx = self._free_bufs.get_nowait()
+        except queue.Empty:
+            try:
+                idx = self._enc_q.get_nowait()
+                self.dropped_frames += 1
+            except queue.Empty:
+                try:
+                    idx = self._free_bufs.get(timeout=0.05)
+                except queue.Empty:
+                    return
+        
+        try:
+            self.hcam.PullImageV4(self._bufs[idx], 0, self.bits, 0, None)
+            now = time.time()
+            
+            # With no consumers the frame is just drained, apart from an occasional
+            # encode so get_current_frame() never goes too stale
+            if self._consumers or now - self._last_idle_encode >= self.IDLE_ENCODE_INTERVAL:
+                self._last_idle_encode = now
                 
-                # Check for still image capture (if Snap was called)
-                if self._still_requested:
-                    self._try_pull_still_image()
-                    
-            except toupcam.HRESULTException as e:
-                # Timeout or error - check for still image anyway
-                if self._still_requested:
-                    self._try_pull_still_image()
-                time.sleep(0.01)
+                # Hand the frame to the encoder; the next one is pulled into the other buffer.
+                # If the previous frame is still queued, replace it (latest frame wins).
+                try:
+                    self._enc_q.put_nowait(idx)
+                except queue.Full:
+                    try:
+                        self._free_bufs.put(self._enc_q.get_nowait())
+                        self.dropped_frames += 1
+                    except queue.Empty:
+                        pass
+                    self._enc_q.put_nowait(idx)
+                idx = None
+            
+            # Calculate FPS
+            self._fps_frames += 1
+            if now - self._fps_time >= 1.0:
+                self.fps = self._fps_frames / (now - self._fps_time)
+                self.frame_count += self._fps_frames
+                self._fps_frames = 0
+                self._fps_time = now
+        except toupcam.HRESULTException:
+            pass
+        except Exception as e:
+            print(f"[Camera] Frame pull error: {e}")
+        finally:
+            if idx is not None:
+                self._free_bufs.put(idx)
+    
+    def _encode_frames(self):
+        """Background thread that JPEG-encodes frames pulled by the SDK callback"""
+        while self._running:
+            try:
+                idx = self._enc_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            
+            # A buffer queued across a close or a relayout must not kill the stream for good
+            try:
+                self._process_frame(self._buf_views[idx])
             except Exception as e:
-                print(f"[Camera] Polling error: {e}")
-                time.sleep(0.1)
-        
-        print("[Camera] Polling thread stopped")
+                print(f"[Camera] Frame encode error: {e}")
+            finally:
+                self._free_bufs.put(idx)
     
     def _try_pull_still_image(self):
         """Try to pull a still image if one is ready"""
         try:
             info = toupcam.ToupcamFrameInfoV3()
-            self.hcam.PullImageV3(None, 1, 24, 0, info)  # Peek
+            self.hcam.PullImageV3(None, 1, self.bits, 0, info)  # Peek
             
             if info.width > 0 and info.height > 0:
-                # Still image is ready
-                buf = bytes(toupcam.TDIBWIDTHBYTES(info.width * 24) * info.height)
-                self.hcam.PullImageV3(buf, 1, 24, 0, info)
+                with self._still_lock:
+                    # Only a capture still waiting gets the buffer: a late still from a
+                    # timed-out Snap must not overwrite it while the next one encodes
+                    if self._still_wanted is None:
+                        return
+                    
+                    # Still image is ready: pull into the preallocated buffer (only the
+                    # first row_stride * height bytes are used for smaller resolutions)
+                    self.hcam.PullImageV3(self._still_pData, 1, self.bits, 0, info)
+                    
+                    # Encoding is left to the waiting capture, so live frames keep flowing
+                    self._still_pulled = (info.width, info.height)
+                    self._still_wanted = None
+                    self._still_complete.set()
                 
                 print(f"[Camera] Still image captured: {info.width}x{info.height}")
-                
-                # Convert to JPEG and save
-                self._save_still_image(buf, info.width, info.height)
-                
-                self._still_requested = False
-                self._still_complete.set()
         except toupcam.HRESULTException:
             # No still image ready yet
             pass
     
-    def _save_still_image(self, buf: bytes, width: int, height: int):
-        """Convert raw buffer to JPEG and save"""
-        try:
-            # Handle row stride
-            row_stride = toupcam.TDIBWIDTHBYTES(width * 24)
-            bytes_per_pixel = 3
-            
-            if row_stride != width * bytes_per_pixel:
-                packed_data = bytearray()
-                for y in range(height):
-                    row_start = y * row_stride
-                    row_end = row_start + (width * bytes_per_pixel)
-                    packed_data.extend(buf[row_start:row_end])
-                image = Image.frombytes('RGB', (width, height), bytes(packed_data))
-            else:
-                image = Image.frombytes('RGB', (width, height), buf)
-            
-            # Save the image
-            if self._still_filename:
-                image.save(self._still_filename, quality=95)
-                print(f"[Camera] Saved: {self._still_filename}")
+    def _encode_still_image(self, buf, width: int, height: int) -> bytes:
+        """Convert a raw still buffer to JPEG"""
+        # Handle row stride: view the buffer as rows and drop the padding
+        row_stride = toupcam.TDIBWIDTHBYTES(width * self.bits)
+        bytes_per_pixel = self.bytes_per_pixel
+        
+        if row_stride == width * bytes_per_pixel:
+            # No padding: the raw buffer is already packed, encode it in place
+            pixels = np.frombuffer(buf, dtype=np.uint8, count=row_stride * height)
+            pixels = pixels.reshape(height, width, bytes_per_pixel)
+        else:
+            rows = np.frombuffer(buf, dtype=np.uint8, count=row_stride * height).reshape(height, row_stride)
+            rows = rows[:, :width * bytes_per_pixel].reshape(height, width, bytes_per_pixel)
             
-            # Also store as JPEG bytes
-            buffer = io.BytesIO()
-            image.save(buffer, format='JPEG', quality=95)
+            # Pack into the reused still array (reallocated only when the still size changes)
+            if self._still_rgb is None or self._still_rgb.shape != rows.shape:
+                self._still_rgb = np.empty(rows.shape, dtype=np.uint8)
+            np.copyto(self._still_rgb, rows)
+            pixels = self._still_rgb
+        
+        return _encode_jpeg(pixels, self.STILL_QUALITY, self._still_io, still=True, subsampling=0)
+    
+    def _save_full_frame(self, frame: np.ndarray):
+        """Encode a stream frame at full size and still quality for cameras without Snap"""
+        try:
+            if self._has_padding:
+                np.copyto(self._rgb_packed, frame)
+                frame = self._rgb_packed
+            jpeg_bytes = _encode_jpeg(frame, self.STILL_QUALITY, self._still_io, still=True, subsampling=0)
             with self._still_lock:
-                self._still_image = buffer.getvalue()
-                
+                self._still_image = jpeg_bytes
+                self._still_size = (frame.shape[1], frame.shape[0])
         except Exception as e:
-            print(f"[Camera] Still image save error: {e}")
+            print(f"[Camera] Full frame encode error: {e}")
+        finally:
+            self._still_complete.set()
     
-    def _process_frame(self):
+    def _process_frame(self, frame: np.ndarray):
         """Process a captured frame - ULTRA OPTIMIZED for real-time streaming"""
         try:
-            # Fast path: minimal processing
-            row_stride = toupcam.TDIBWIDTHBYTES(self.img_width * 24)
-            bytes_per_pixel = 3
+            if self._full_frame_requested:
+                self._full_frame_requested = False
+                self._save_full_frame(frame)
             
-            if row_stride != self.img_width * bytes_per_pixel:
-                # Has padding - fast removal
-                packed_data = bytearray(self.img_width * self.img_height * 3)
-                src = 0
-                dst = 0
-                row_bytes = self.img_width * bytes_per_pixel
-                for _ in range(self.img_height):
-                    packed_data[dst:dst + row_bytes] = self.pData[src:src + row_bytes]
-                    src += row_stride
-                    dst += row_bytes
-                image = Image.frombytes('RGB', (self.img_width, self.img_height), bytes(packed_data))
+            # Fast path: the strided view already skips row padding; pack it into the
+            # reused array only when there is padding, otherwise encode it in place
+            if self._scale_factor > 1:
+                # Oversized for streaming: downscale first, so the encoder sees fewer pixels
+                pixels = self._stream_scaled
+                height, width = pixels.shape[:2]
+                if cv2 is not None:
+                    # Box filter (INTER_AREA) straight from the padded view into the reused array
+                    cv2.resize(frame[:, :, 0] if self.bytes_per_pixel == 1 else frame, (width, height),
+                               dst=pixels[:, :, 0] if self.bytes_per_pixel == 1 else pixels,
+                               interpolation=cv2.INTER_AREA)
+                else:
+                    f = self._scale_factor
+                    np.copyto(pixels, frame[:height * f:f, :width * f:f])
+            elif self._has_padding:
+                pixels = self._rgb_packed
+                np.copyto(pixels, frame)
             else:
-                image = Image.frombytes('RGB', (self.img_width, self.img_height), self.pData)
+                pixels = frame
             
-            # ULTRA LOW QUALITY for maximum speed streaming
-            buffer = io.BytesIO()
-            image.save(buffer, format='JPEG', quality=35, optimize=False, subsampling=2)
-            jpeg_bytes = buffer.getvalue()
+            # Low quality for maximum speed streaming, adjusted to the encode time
+            start = time.perf_counter()
+            jpeg_bytes = _encode_jpeg(pixels, self.stream_quality, self._jpeg_io,
+                                      optimize=False, subsampling=2)
+            if self.adaptive_quality:
+                self._adapt_stream_quality(time.perf_counter() - start)
             
-            with self._frame_lock:
-                self._current_frame = jpeg_bytes
-            self._frame_available.set()
+            # Publish: swap in the new frame for /frame, then wake the stream clients
+            self._current_frame = jpeg_bytes
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._publish_frame, jpeg_bytes)
             
         except Exception as e:
             pass  # Silent fail for speed
     
+    def _adapt_stream_quality(self, encode_time: float):
+        """Lower the streaming quality while encoding can't keep up, raise it when there's headroom"""
+        self._encode_ema += 0.1 * (encode_time - self._encode_ema)
+        budget = 1.0 / self.STREAM_TARGET_FPS
+        
+        if self._encode_ema > budget:
+            self._quality_streak = min(self._quality_streak, 0) - 1
+            if -self._quality_streak >= self.QUALITY_LOWER_FRAMES:
+                self.stream_quality = max(self.STREAM_QUALITY_MIN, self.stream_quality - self.STREAM_QUALITY_STEP)
+                self._quality_streak = 0
+        elif self._encode_ema < 0.5 * budget:
+            self._quality_streak = max(self._quality_streak, 0) + 1
+            if self._quality_streak >= self.QUALITY_RAISE_FRAMES:
+                # Never pull a quality set above the cap back down here
+                self.stream_quality = max(self.stream_quality,
+                                          min(self.STREAM_QUALITY_MAX, self.stream_quality + self.STREAM_QUALITY_STEP))
+                self._quality_streak = 0
+        else:
+            self._quality_streak = 0
+    
     def get_current_frame(self) -> Optional[bytes]:
         """Get the current frame as JPEG bytes (thread-safe)"""
-        with self._frame_lock:
-            return self._current_frame
+        return self._current_frame
     
-    def wait_for_frame(self, timeout: float = 1.0) -> Optional[bytes]:
-        """Wait for a new frame and return it"""
-        self._frame_available.wait(timeout=timeout)
-        self._frame_available.clear()
-        return self.get_current_frame()
+    def bind_event_loop(self, loop: asyncio.AbstractEventLoop):
+        """Deliver new frames to subscribers on this loop"""
+        self._loop = loop
     
-    def capture_still_image(self, filename: Optional[str] = None, resolution_index: Optional[int] = None) -> str:
+    def subscribe(self) -> asyncio.Queue:
+        """Register an async streaming client, returns a queue holding its next frame (call on the loop)"""
+        frames = asyncio.Queue(maxsize=1)
+        frame = self.get_current_frame()
+        if frame:
+            frames.put_nowait(frame)
+        self._subscribers.add(frames)
+        self.add_consumer()
+        return frames
+    
+    def unsubscribe(self, frames: asyncio.Queue):
+        """Unregister a queue returned by subscribe()"""
+        if frames in self._subscribers:
+            self._subscribers.discard(frames)
+            self.remove_consumer()
+    
+    def _publish_frame(self, frame: bytes):
+        """Runs on the bound loop: hand a new frame to every subscriber, dropping any it hasn't sent yet"""
+        for frames in self._subscribers:
+            try:
+                frames.put_nowait(frame)
+            except asyncio.QueueFull:
+                frames.get_nowait()
+                frames.put_nowait(frame)
+    
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """Queue a camera call on the single camera thread"""
+        return self._cam_executor.submit(fn, *args, **kwargs)
+    
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Await a camera call on the single camera thread, leaving the event loop free"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._cam_executor, functools.partial(fn, *args, **kwargs))
+    
+    def add_consumer(self):
+        """Register a streaming client; frames are fully encoded only while one is registered"""
+        with self._consumer_lock:
+            self._consumers += 1
+    
+    def remove_consumer(self):
+        """Unregister a streaming client registered with add_consumer()"""
+        with self._consumer_lock:
+            self._consumers = max(0, self._consumers - 1)
+    
+    def capture_still_image(self, filename: Optional[str] = None, resolution_index: Optional[int] = None,
+                            directory: Optional[str] = None) -> str:
         """
         Capture a high-resolution still image using hardware Snap
         
         Args:
             filename: Output filename, auto-generated if None
             resolution_index: Still resolution index, or None for highest
+            directory: Directory for relative filenames, or None for the working directory
             
         Returns:
             Path to saved image
         """
+        if filename is None:
+            # Wall-clock time keeps names in capture order across restarts, the counter
+            # within a second (one strftime per capture is nothing next to the Snap)
+            filename = f"capture_{time.strftime('%Y%m%d_%H%M%S')}_{next(self._capture_seq):06d}.jpg"
+        if directory is not None:
+            filename = os.path.join(directory, filename)  # Absolute filenames are kept as given
+        
+        jpeg_bytes = self.capture_image_bytes(resolution_index)
+        with open(filename, 'wb') as f:
+            f.write(jpeg_bytes)
+        print(f"[Camera] Saved: {filename}")
+        return filename
+    
+    def capture_image_bytes(self, resolution_index: Optional[int] = None) -> bytes:
+        """
+        Capture a high-resolution still image using hardware Snap, without saving it
+        
+        Encodes on the calling thread; calls must not overlap (use submit()/run()).
+        
+        Args:
+            resolution_index: Still resolution index, or None for highest
+            
+        Returns:
+            JPEG bytes of the captured image
+        """
         if not self.hcam:
             raise RuntimeError("Camera not open")
         
-        if filename is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"capture_{timestamp}.jpg"
-        
         still_count = self.cur.model.still
         
+        with self._still_lock:
+            self._still_image = None  # Only a successful encode of this capture fills it
+            self._still_pulled = None
+            self._still_complete.clear()
+        
         if still_count == 0:
-            # No hardware still support - capture current frame at full quality
+            # No hardware still support - encode the next frame at full stream
+            # resolution (not downscaled for streaming) and still quality
             print("[Camera] No still capture support, using current frame")
-            frame = self.get_current_frame()
-            if frame:
-                with open(filename, 'wb') as f:
-                    f.write(frame)
-                self.capture_count += 1
-                return filename
-            raise RuntimeError("No frame available")
+            self._full_frame_requested = True
+            self.add_consumer()  # Make sure the next frame reaches the encoder
+            try:
+                self._still_complete.wait(timeout=2.0)
+            finally:
+                self.remove_consumer()
+                self._full_frame_requested = False
+            return self._take_still("No frame available")
         
         # Use hardware Snap for high-res capture
         if resolution_index is None:
@@ -358,30 +800,56 @@ class ToupCameraManager:
         if resolution_index < 0 or resolution_index >= still_count:
             resolution_index = 0
         
-        self._still_filename = filename
-        self._still_requested = True
-        self._still_complete.clear()
-        
         print(f"[Camera] Requesting still image at index {resolution_index}")
         
+        with self._still_lock:
+            self._still_gen += 1
+            gen = self._still_wanted = self._still_gen
         try:
             self.hcam.Snap(resolution_index)
         except toupcam.HRESULTException as e:
-            self._still_requested = False
+            self._drop_still_request(gen)
             raise RuntimeError(f"Snap failed: {e}")
         
         # Wait for still image to be captured
-        if self._still_complete.wait(timeout=10.0):
-            self.capture_count += 1
-            return filename
-        else:
-            self._still_requested = False
+        if not self._still_complete.wait(timeout=10.0):
+            self._drop_still_request(gen)
             raise RuntimeError("Still capture timeout")
+        with self._still_lock:
+            width, height = self._still_pulled
+        
+        # The SDK thread only pulled the raw image; encode it here
+        try:
+            jpeg_bytes = self._encode_still_image(self._still_pData, width, height)
+        except Exception as e:
+            raise RuntimeError(f"Still image encode failed: {e}")
+        self.capture_count += 1
+        self.last_capture_size = (width, height)
+        return jpeg_bytes
+    
+    def _drop_still_request(self, gen: int):
+        """Stop waiting for the still of Snap request gen; it is ignored if it turns up later"""
+        with self._still_lock:
+            if self._still_wanted == gen:
+                self._still_wanted = None
+    
+    def _take_still(self, error: str) -> bytes:
+        """Return the JPEG left by the full-frame encoder, raising if there is none"""
+        with self._still_lock:
+            jpeg_bytes = self._still_image
+            size = self._still_size
+        if jpeg_bytes is None:
+            raise RuntimeError(error)
+        self.capture_count += 1
+        self.last_capture_size = size
+        return jpeg_bytes
     
     def get_resolutions(self) -> list:
         """Get available streaming/preview resolutions"""
         if not self.cur:
             return []
+        if self._cached_resolutions is not None:
+            return self._cached_resolutions
         
         resolutions = []
         for i in range(self.cur.model.preview):
@@ -391,6 +859,7 @@ class ToupCameraManager:
                 "height": self.cur.model.res[i].height,
                 "current": i == self.res
             })
+        self._cached_resolutions = resolutions
         return resolutions
     
     def set_resolution(self, index: int) -> bool:
@@ -398,28 +867,35 @@ class ToupCameraManager:
         if not self.hcam or index < 0 or index >= self.cur.model.preview:
             return False
         
-        # Stop polling
-        was_running = self._running
-        self._running = False
-        if self._poll_thread:
-            self._poll_thread.join(timeout=2.0)
-        
+        # Stop the camera (no more callbacks), then wait for the encoder to hand back
+        # both buffers; the encoder thread itself keeps running
         self.hcam.Stop()
+        held = self._reclaim_buffers()
+        if len(held) < len(self._bufs):
+            # The encoder still owns a buffer: keep the old layout rather than resize under it
+            for idx in held:
+                self._free_bufs.put(idx)
+            print("[Camera] Encoder busy, resolution left unchanged")
+            try:
+                self.hcam.StartPullModeWithCallback(self._event_callback, self)
+            except toupcam.HRESULTException:
+                pass
+            return False
+        
         self.res = index
+        self._cached_resolutions = None  # "current" flag moved
         self.img_width = self.cur.model.res[index].width
         self.img_height = self.cur.model.res[index].height
-        self.pData = bytes(toupcam.TDIBWIDTHBYTES(self.img_width * 24) * self.img_height)
+        self._layout_stream_buffers()
+        self._last_idle_encode = 0.0  # Publish a frame at the new size straight away
+        for idx in held:
+            self._free_bufs.put(idx)
         
         print(f"[Camera] Resolution changed to: {self.img_width}x{self.img_height}")
         
         self.hcam.put_eSize(self.res)
         try:
-            self.hcam.StartPullModeWithCallback(None, None)
-            
-            if was_running:
-                self._running = True
-                self._poll_thread = threading.Thread(target=self._poll_frames, daemon=True)
-                self._poll_thread.start()
+            self.hcam.StartPullModeWithCallback(self._event_callback, self)
             
             return True
         except toupcam.HRESULTException:
@@ -435,10 +911,12 @@ class ToupCameraManager:
             # No dedicated still resolutions
             if index >= 0 and index < self.cur.model.preview:
                 self.snap_res = index
+                self._cached_still_resolutions = None
                 return True
         else:
             if index >= 0 and index < still_count:
                 self.snap_res = index
+                self._cached_still_resolutions = None
                 return True
         
         return False
@@ -448,7 +926,9 @@ class ToupCameraManager:
         if not self.hcam:
             return {"min": 0, "max": 0, "current": 0}
         
-        uimin, uimax, uidef = self.hcam.get_ExpTimeRange()
+        if self._exp_bounds is None:
+            self._exp_bounds = self.hcam.get_ExpTimeRange()
+        uimin, uimax, uidef = self._exp_bounds
         current = self.hcam.get_ExpoTime()
         return {"min": uimin, "max": uimax, "default": uidef, "current": current}
     
@@ -469,7 +949,9 @@ class ToupCameraManager:
             return {"min": 0, "max": 0, "current": 0}
         
         try:
-            usmin, usmax, usdef = self.hcam.get_ExpoAGainRange()
+            if self._gain_bounds is None:
+                self._gain_bounds = self.hcam.get_ExpoAGainRange()
+            usmin, usmax, usdef = self._gain_bounds
             current = self.hcam.get_ExpoAGain()
             return {"min": usmin, "max": usmax, "default": usdef, "current": current}
         except toupcam.HRESULTException:
@@ -486,6 +968,16 @@ class ToupCameraManager:
         except toupcam.HRESULTException:
             return False
     
+    def set_stream_quality(self, quality: Optional[int] = None, adaptive: bool = False) -> bool:
+        """Set the streaming JPEG quality; pinned unless adaptive, which keeps tuning from there"""
+        if quality is not None:
+            if not 1 <= quality <= 100:
+                return False
+            self.stream_quality = quality
+        self._quality_streak = 0
+        self.adaptive_quality = adaptive
+        return True
+    
     def get_auto_exposure(self) -> bool:
         """Check if auto exposure is enabled"""
         if not self.hcam:
@@ -538,6 +1030,13 @@ class ToupCameraManager:
         except toupcam.HRESULTException:
             return False
     
+    def get_stream_size(self) -> Dict[str, int]:
+        """Size of the frames actually streamed, after any downscale"""
+        if self._stream_scaled is not None:
+            height, width = self._stream_scaled.shape[:2]
+            return {"width": width, "height": height}
+        return {"width": self.img_width, "height": self.img_height}
+    
     def get_camera_info(self) -> Dict[str, Any]:
         """Get comprehensive camera information"""
         if not self.cur:
@@ -552,12 +1051,16 @@ class ToupCameraManager:
                 "height": self.img_height,
                 "index": self.res
             },
+            "stream_size": self.get_stream_size(),
             "capture_resolution": {
                 "index": self.snap_res,
                 "still_count": self.cur.model.still
             },
             "frame_count": self.frame_count,
             "fps": round(self.fps, 1),
+            "dropped_frames": self.dropped_frames,
+            "stream_quality": self.stream_quality,
+            "adaptive_quality": self.adaptive_quality,
             "capture_count": self.capture_count,
             "exposure": self.get_exposure_range(),
             "gain": self.get_gain_range(),
@@ -0,0 +1,79 @@
+"""
+Routes shared by main.py and thread.py
+MJPEG live stream and downloads of saved captures
+"""
+import os
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse, FileResponse
+
+from camera_manager import camera_manager
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CAPTURES_DIR = os.path.join(BASE_DIR, "captures")
+os.makedirs(CAPTURES_DIR, exist_ok=True)
+
+router = APIRouter()
+
+
+# MJPEG streaming generator
+_MJPEG_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+
+
+async def generate_mjpeg():
+    """Generate MJPEG stream from camera frames"""
+    # Frames are only encoded while at least one client is streaming; the
+    # queue holds just the newest one, so a slow client skips frames
+    frames = camera_manager.subscribe()
+    try:
+        while True:
+            if not camera_manager.is_open:
+                await asyncio.sleep(0.5)
+                continue
+
+            try:
+                frame = await asyncio.wait_for(frames.get(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+
+            # Header, JPEG and trailer go out as separate chunks so the frame itself is
+            # never concatenated; Content-Length lets clients skip boundary scanning
+            yield _MJPEG_HEADER + b'%d\r\n\r\n' % len(frame)
+            yield frame
+            yield b'\r\n'
+    finally:
+        camera_manager.unsubscribe(frames)
+
+
+@router.get("/stream")
+async def video_stream():
+    """MJPEG video stream endpoint (uses streaming resolution)"""
+    return StreamingResponse(
+        generate_mjpeg(),
+        media_type="multipart/x-mixed-replace; boundary=frame",
+        # Don't let browsers cache or reverse proxies (nginx) buffer the stream
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    )
+
+
+def capture_relpath(path: str) -> Optional[str]:
+    """Path relative to captures/ ('/'-separated), or None if it lies outside"""
+    root = os.path.realpath(CAPTURES_DIR)
+    full_path = os.path.realpath(path)
+    try:
+        if os.path.commonpath([full_path, root]) != root:
+            return None
+    except ValueError:
+        return None  # Different drive (Windows)
+    return os.path.relpath(full_path, root).replace(os.sep, "/")
+
+
+@router.get("/captures/{path:path}")
+async def get_capture(path: str):
+    """Download a saved capture (FileResponse streams it straight from disk)"""
+    full_path = os.path.realpath(os.path.join(CAPTURES_DIR, path))
+    if capture_relpath(full_path) is None or not os.path.isfile(full_path):
+        raise HTTPException(status_code=404, detail="Capture not found")
+    return FileResponse(full_path, media_type="image/jpeg")
@@ -9,63 +9,109 @@ from datetime import datetime
 from typing import Optional
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from starlette.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ConfigDict, Field
 
+import toupcam
 from camera_manager import camera_manager
+from camera_routes import router as camera_routes, capture_relpath, CAPTURES_DIR
 
+# orjson serializes the status/settings dicts several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# Pydantic models for request/response
-class ExposureSettings(BaseModel):
-    time_us: int
 
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (plain JSONResponse when it isn't installed)"""
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
 
-class GainSettings(BaseModel):
-    percent: int
 
+# Pydantic models for request/response (frozen, unknown fields rejected,
+# bounds checked by pydantic-core before the handler runs)
+class FrozenModel(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
 
-class ResolutionSettings(BaseModel):
-    index: int
 
+class ExposureSettings(FrozenModel):
+    time_us: int = Field(ge=1)
 
-class CaptureResolutionSettings(BaseModel):
-    index: int
 
+class GainSettings(FrozenModel):
+    percent: int = Field(ge=toupcam.TOUPCAM_EXPOGAIN_MIN)
 
-class WhiteBalanceSettings(BaseModel):
-    temp: Optional[int] = None
-    tint: Optional[int] = None
 
+class ResolutionSettings(FrozenModel):
+    index: int = Field(ge=0)
 
-class AutoExposureSettings(BaseModel):
+
+class CaptureResolutionSettings(FrozenModel):
+    index: int = Field(ge=0)
+
+
+class WhiteBalanceSettings(FrozenModel):
+    temp: Optional[int] = Field(default=None, ge=toupcam.TOUPCAM_TEMP_MIN, le=toupcam.TOUPCAM_TEMP_MAX)
+    tint: Optional[int] = Field(default=None, ge=toupcam.TOUPCAM_TINT_MIN, le=toupcam.TOUPCAM_TINT_MAX)
+
+
+class StreamQualitySettings(FrozenModel):
+    quality: Optional[int] = Field(default=None, ge=1, le=100)
+    adaptive: bool = False
+
+
+class AutoExposureSettings(FrozenModel):
     enabled: bool
 
 
-class CaptureRequest(BaseModel):
-    resolution_index: Optional[int] = None
+class CaptureRequest(FrozenModel):
+    resolution_index: Optional[int] = Field(default=None, ge=0)
     filename: Optional[str] = None
 
 
-class CaptureResponse(BaseModel):
+class CaptureResponse(FrozenModel):
     success: bool
     filename: str = ""
+    url: str = ""  # Download link under /captures/, when saved there
     message: str = ""
     width: int = 0
     height: int = 0
 
 
+class SelectiveGZipMiddleware:
+    """GZip JSON/HTML responses but never the MJPEG stream or JPEG downloads"""
+    
+    # GZip would hold multipart frames back in its buffer, and JPEGs don't shrink anyway
+    EXCLUDED_PATHS = ("/stream", "/frame", "/captures/")
+    
+    def __init__(self, app, minimum_size: int = 512):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(self.EXCLUDED_PATHS):
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
 # Lifespan management
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage camera lifecycle"""
+    camera_manager.bind_event_loop(asyncio.get_running_loop())
     # Startup: try to open camera
-    camera_manager.open_camera()
+    await camera_manager.run(camera_manager.open_camera)
     yield
     # Shutdown: close camera
-    camera_manager.close_camera()
+    await camera_manager.run(camera_manager.close_camera)
 
 
 # Create FastAPI app
@@ -73,8 +119,10 @@ app = FastAPI(
     title="ToupCamera Web Streaming",
     description="Live video streaming and high-resolution capture from ToupCamera",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=512)
 
 # Setup templates and static files
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -87,24 +135,21 @@ os.makedirs(static_dir, exist_ok=True)
 
 templates = Jinja2Templates(directory=templates_dir)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
+app.include_router(camera_routes)  # /stream and /captures/
 
 
-# MJPEG streaming generator
-async def generate_mjpeg():
-    """Generate MJPEG stream from camera frames"""
-    while True:
-        if not camera_manager.is_open:
-            await asyncio.sleep(0.5)
-            continue
-        
-        frame = camera_manager.get_current_frame()
-        if frame:
-            yield (
-                b'--frame\r\n'
-                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n'
-            )
-        
-        await asyncio.sleep(0.008)  # ~120 FPS max for real-time streaming
+def read_camera(getter):
+    """
+    Call a read-only camera getter directly on the event loop
+    
+    Getters are quick SDK reads; keeping them off the camera thread means UI polls
+    don't queue behind a Snap or a resolution change. A close landing mid-read is
+    reported as 503.
+    """
+    try:
+        return getter()
+    except (AttributeError, toupcam.HRESULTException):
+        raise HTTPException(status_code=503, detail="Camera not connected")
 
 
 # Routes
@@ -114,23 +159,15 @@ async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
-@app.get("/stream")
-async def video_stream():
-    """MJPEG video stream endpoint (uses streaming resolution)"""
-    return StreamingResponse(
-        generate_mjpeg(),
-        media_type="multipart/x-mixed-replace; boundary=frame"
-    )
-
-
 @app.get("/frame")
 async def get_frame():
     """Get a single JPEG frame at streaming resolution"""
     frame = camera_manager.get_current_frame()
     if frame:
-        return StreamingResponse(
-            iter([frame]),
-            media_type="image/jpeg"
+        return Response(
+            content=frame,
+            media_type="image/jpeg",
+            headers={"Cache-Control": "no-store"}
         )
     raise HTTPException(status_code=503, detail="No frame available")
 
@@ -146,22 +183,28 @@ async def capture_image(request: CaptureRequest = CaptureRequest()):
         raise HTTPException(status_code=503, detail="Camera not connected")
     
     try:
-        saved_path = camera_manager.capture_still_image(
+        # Snap blocks for up to seconds: run it on the camera thread so streams keep flowing
+        saved_path = await camera_manager.run(
+            camera_manager.capture_still_image,
             filename=request.filename,
-            resolution_index=request.resolution_index
+            resolution_index=request.resolution_index,
+            directory=CAPTURES_DIR
         )
         
-        # Get resolution info
-        still_res = camera_manager.get_still_resolutions()
-        res_index = request.resolution_index if request.resolution_index is not None else 0
-        width = height = 0
-        if still_res and res_index < len(still_res):
-            width = still_res[res_index]["width"]
-            height = still_res[res_index]["height"]
+        # Report captures under captures/ by the name /captures/ serves them as
+        relpath = capture_relpath(saved_path)
+        url = ""
+        if relpath is not None:
+            saved_path = relpath
+            url = f"/captures/{relpath}"
+        
+        # Size actually captured (may differ from the requested resolution)
+        width, height = camera_manager.last_capture_size
         
         return CaptureResponse(
             success=True,
             filename=saved_path,
+            url=url,
             message=f"High-res image saved: {saved_path}",
             width=width,
             height=height
@@ -176,7 +219,10 @@ async def capture_image(request: CaptureRequest = CaptureRequest()):
 @app.get("/camera/status")
 async def camera_status():
     """Get camera connection status and info"""
-    return camera_manager.get_camera_info()
+    try:
+        return camera_manager.get_camera_info()
+    except (AttributeError, toupcam.HRESULTException):
+        return {"connected": False}  # Closed while reading
 
 
 @app.post("/camera/open")
@@ -185,7 +231,7 @@ async def open_camera():
     if camera_manager.is_open:
         return {"success": True, "message": "Camera already open"}
     
-    success = camera_manager.open_camera()
+    success = await camera_manager.run(camera_manager.open_camera)
     if success:
         return {"success": True, "message": "Camera opened successfully"}
     else:
@@ -195,7 +241,7 @@ async def open_camera():
 @app.post("/camera/close")
 async def close_camera():
     """Close/disconnect camera"""
-    camera_manager.close_camera()
+    await camera_manager.run(camera_manager.close_camera)
     return {"success": True, "message": "Camera closed"}
 
 
@@ -205,14 +251,17 @@ async def get_settings():
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    return {
-        "exposure": camera_manager.get_exposure_range(),
-        "gain": camera_manager.get_gain_range(),
-        "auto_exposure": camera_manager.get_auto_exposure(),
-        "white_balance": camera_manager.get_white_balance(),
-        "resolutions": camera_manager.get_resolutions(),
-        "still_resolutions": camera_manager.get_still_resolutions()
-    }
+    def read_settings():
+        return {
+            "exposure": camera_manager.get_exposure_range(),
+            "gain": camera_manager.get_gain_range(),
+            "auto_exposure": camera_manager.get_auto_exposure(),
+            "white_balance": camera_manager.get_white_balance(),
+            "resolutions": camera_manager.get_resolutions(),
+            "still_resolutions": camera_manager.get_still_resolutions()
+        }
+    
+    return read_camera(read_settings)
 
 
 @app.get("/settings/resolutions")
@@ -220,7 +269,7 @@ async def get_resolutions():
     """Get available streaming resolutions"""
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
-    return {"resolutions": camera_manager.get_resolutions()}
+    return {"resolutions": read_camera(camera_manager.get_resolutions)}
 
 
 @app.get("/settings/still_resolutions")
@@ -228,7 +277,7 @@ async def get_still_resolutions():
     """Get available still/capture resolutions"""
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
-    return {"still_resolutions": camera_manager.get_still_resolutions()}
+    return {"still_resolutions": read_camera(camera_manager.get_still_resolutions)}
 
 
 @app.put("/settings/resolution")
@@ -242,11 +291,11 @@ async def set_resolution(settings: ResolutionSettings):
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.set_resolution(settings.index)
+    success = await camera_manager.run(camera_manager.set_resolution, settings.index)
     if success:
         return {
             "success": True,
-            "resolutions": camera_manager.get_resolutions(),
+            "resolutions": read_camera(camera_manager.get_resolutions),
             "message": f"Streaming resolution changed"
         }
     raise HTTPException(status_code=400, detail="Failed to set resolution")
@@ -258,11 +307,11 @@ async def set_capture_resolution(settings: CaptureResolutionSettings):
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.set_capture_resolution(settings.index)
+    success = await camera_manager.run(camera_manager.set_capture_resolution, settings.index)
     if success:
         return {
             "success": True,
-            "still_resolutions": camera_manager.get_still_resolutions()
+            "still_resolutions": read_camera(camera_manager.get_still_resolutions)
         }
     raise HTTPException(status_code=400, detail="Failed to set capture resolution")
 
@@ -273,9 +322,9 @@ async def set_exposure(settings: ExposureSettings):
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.set_exposure(settings.time_us)
+    success = await camera_manager.run(camera_manager.set_exposure, settings.time_us)
     if success:
-        return {"success": True, "exposure": camera_manager.get_exposure_range()}
+        return {"success": True, "exposure": read_camera(camera_manager.get_exposure_range)}
     raise HTTPException(status_code=400, detail="Failed to set exposure")
 
 
@@ -285,21 +334,38 @@ async def set_gain(settings: GainSettings):
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.set_gain(settings.percent)
+    success = await camera_manager.run(camera_manager.set_gain, settings.percent)
     if success:
-        return {"success": True, "gain": camera_manager.get_gain_range()}
+        return {"success": True, "gain": read_camera(camera_manager.get_gain_range)}
     raise HTTPException(status_code=400, detail="Failed to set gain")
 
 
+@app.put("/settings/stream_quality")
+async def set_stream_quality(settings: StreamQualitySettings):
+    """
+    Set streaming JPEG quality (stills always use maximum quality)
+    
+    A quality alone pins it; adaptive=true lets encode time tune it again.
+    """
+    success = camera_manager.set_stream_quality(settings.quality, settings.adaptive)
+    if success:
+        return {
+            "success": True,
+            "stream_quality": camera_manager.stream_quality,
+            "adaptive": camera_manager.adaptive_quality
+        }
+    raise HTTPException(status_code=400, detail="Failed to set stream quality")
+
+
 @app.put("/settings/auto_exposure")
 async def set_auto_exposure(settings: AutoExposureSettings):
     """Enable or disable auto exposure"""
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.set_auto_exposure(settings.enabled)
+    success = await camera_manager.run(camera_manager.set_auto_exposure, settings.enabled)
     if success:
-        return {"success": True, "auto_exposure": camera_manager.get_auto_exposure()}
+        return {"success": True, "auto_exposure": read_camera(camera_manager.get_auto_exposure)}
     raise HTTPException(status_code=400, detail="Failed to set auto exposure")
 
 
@@ -309,9 +375,9 @@ async def set_white_balance(settings: WhiteBalanceSettings):
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.set_white_balance(settings.temp, settings.tint)
+    success = await camera_manager.run(camera_manager.set_white_balance, settings.temp, settings.tint)
     if success:
-        return {"success": True, "white_balance": camera_manager.get_white_balance()}
+        return {"success": True, "white_balance": read_camera(camera_manager.get_white_balance)}
     raise HTTPException(status_code=400, detail="Failed to set white balance")
 
 
@@ -321,7 +387,7 @@ async def auto_white_balance():
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
     
-    success = camera_manager.auto_white_balance()
+    success = await camera_manager.run(camera_manager.auto_white_balance)
     if success:
         return {"success": True, "message": "Auto white balance performed"}
     raise HTTPException(status_code=400, detail="Failed to perform auto white balance")
@@ -329,4 +395,7 @@ async def auto_white_balance():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Single worker: the camera belongs to this process. uvloop/httptools are picked
+    # up automatically when installed (uvicorn[standard]); no per-request access log
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto",
+                log_level="warning", access_log=False)
@@ -10,39 +10,76 @@ Arduino commands:
 
 import os
 import time
+import queue
+import logging
+import logging.handlers
+import itertools
 import threading
 import serial
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 
+import toupcam
 from camera_manager import camera_manager
+from camera_routes import router as camera_routes, capture_relpath, CAPTURES_DIR
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+# =========================
+# Logging
+# =========================
+
+log = logging.getLogger(__name__)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    # Threads only enqueue records; the listener thread does the console writes
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    return listener
 
 # =========================
 # FastAPI Models
 # =========================
 
-class ExposureSettings(BaseModel):
-    time_us: int
+class FrozenModel(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+class ExposureSettings(FrozenModel):
+    time_us: int = Field(ge=1)
 
-class GainSettings(BaseModel):
-    percent: int
+class GainSettings(FrozenModel):
+    percent: int = Field(ge=toupcam.TOUPCAM_EXPOGAIN_MIN)
 
-class ResolutionSettings(BaseModel):
-    index: int
+class ResolutionSettings(FrozenModel):
+    index: int = Field(ge=0)
 
-class WhiteBalanceSettings(BaseModel):
-    temp: Optional[int] = None
-    tint: Optional[int] = None
+class WhiteBalanceSettings(FrozenModel):
+    temp: Optional[int] = Field(default=None, ge=toupcam.TOUPCAM_TEMP_MIN, le=toupcam.TOUPCAM_TEMP_MAX)
+    tint: Optional[int] = Field(default=None, ge=toupcam.TOUPCAM_TINT_MIN, le=toupcam.TOUPCAM_TINT_MAX)
 
-class AutoExposureSettings(BaseModel):
+class AutoExposureSettings(FrozenModel):
     enabled: bool
 
 # =========================
@@ -51,12 +88,13 @@ class AutoExposureSettings(BaseModel):
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-CAPTURE_ROOT = os.path.join(BASE_DIR, "captures")
-os.makedirs(CAPTURE_ROOT, exist_ok=True)
-
 current_session_dir = None
-session_locked = False
-state_lock = threading.Lock()
+capture_seq = itertools.count()  # Numbers captures within the current session
+session_locked = threading.Event()  # Set between N and S
+state_lock = threading.Lock()  # Guards current_session_dir only
+
+# Captures are written here so the serial thread can take the next command right away
+_io_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="capture-io")
 
 # =========================
 # FastAPI Setup
@@ -72,33 +110,18 @@ templates = Jinja2Templates(directory=templates_dir)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    camera_manager.bind_event_loop(asyncio.get_running_loop())
     yield
 
 app = FastAPI(
     title="ToupCamera Web Streaming",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
-
-# =========================
-# MJPEG Stream
-# =========================
-
-async def generate_mjpeg():
-    while True:
-        if not camera_manager.is_open:
-            await asyncio.sleep(0.5)
-            continue
-
-        frame = camera_manager.get_current_frame()
-        if frame:
-            yield (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-            )
-        await asyncio.sleep(0.033)
+app.include_router(camera_routes)  # /stream and /captures/
 
 # =========================
 # Routes
@@ -108,65 +131,83 @@ async def generate_mjpeg():
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.get("/stream")
-async def video_stream():
-    return StreamingResponse(
-        generate_mjpeg(),
-        media_type="multipart/x-mixed-replace; boundary=frame"
-    )
-
 @app.post("/capture")
 async def capture_http():
     if not camera_manager.is_open:
         raise HTTPException(status_code=503, detail="Camera not connected")
 
-    filename = datetime.now().strftime("%Y%m%d_%H%M%S.jpg")
-    path = camera_manager.capture_image(filename)
-    return {"success": True, "file": path}
+    path = await camera_manager.run(camera_manager.capture_still_image, None,
+                                    directory=CAPTURES_DIR)
+    relpath = capture_relpath(path)
+    return {"success": True, "file": relpath,
+            "url": f"/captures/{relpath}"}
 
 # =========================
 # Capture Session Logic
 # =========================
 
 def create_new_session():
-    global current_session_dir, session_locked
-    with state_lock:
-        if session_locked:
-            print("[SERIAL] Session locked, ignoring N")
-            return
+    global current_session_dir, capture_seq
+    if session_locked.is_set():
+        log.info("[SERIAL] Session locked, ignoring N")
+        return
 
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        current_session_dir = os.path.join(CAPTURE_ROOT, f"session_{ts}")
-        os.makedirs(current_session_dir, exist_ok=True)
-        session_locked = True
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    session_dir = os.path.join(CAPTURES_DIR, f"session_{ts}")
+    os.makedirs(session_dir, exist_ok=True)
+    with state_lock:
+        current_session_dir = session_dir
+        capture_seq = itertools.count()
+    session_locked.set()
 
-        print(f"[SERIAL] New session created: {current_session_dir}")
+    log.info("[SERIAL] New session created: %s", session_dir)
 
 def capture_to_session():
     with state_lock:
         if not current_session_dir:
-            print("[SERIAL] No active session, ignoring C")
+            log.info("[SERIAL] No active session, ignoring C")
             return
         target_dir = current_session_dir
+        seq = next(capture_seq)
 
     if not camera_manager.is_open:
-        print("[SERIAL] Camera not open")
+        log.warning("[SERIAL] Camera not open")
         return
 
-    filename = datetime.now().strftime("%H%M%S_%f.jpg")
+    filename = f"{time.strftime('%Y%m%d_%H%M%S')}_{seq:06d}.jpg"
     filepath = os.path.join(target_dir, filename)
 
     try:
-        camera_manager.capture_image(filepath)
-        print(f"[SERIAL] Captured: {filepath}")
+        jpeg_bytes = camera_manager.submit(camera_manager.capture_image_bytes).result()
     except Exception as e:
-        print(f"[SERIAL] Capture failed: {e}")
+        log.error("[SERIAL] Capture failed: %s", e)
+        return
+
+    _io_pool.submit(_write_jpeg, filepath, jpeg_bytes)
+
+def _write_jpeg(filepath: str, jpeg_bytes: bytes):
+    """Write a capture in one go and keep it from crowding the page cache"""
+    try:
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            view = memoryview(jpeg_bytes)
+            while view:
+                view = view[os.write(fd, view):]
+            # Flush, then drop the now clean pages (both POSIX only)
+            if hasattr(os, "fdatasync"):
+                os.fdatasync(fd)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+        log.info("[SERIAL] Captured: %s", filepath)
+    except Exception as e:
+        # Nothing else sees errors raised inside the pool
+        log.error("[SERIAL] Capture write failed: %s", e)
 
 def end_session():
-    global session_locked
-    with state_lock:
-        session_locked = False
-    print("[SERIAL] Session ended. Waiting for next N")
+    session_locked.clear()
+    log.info("[SERIAL] Session ended. Waiting for next N")
 
 # =========================
 # Serial Thread
@@ -175,16 +216,20 @@ def end_session():
 def serial_worker(port: str, baudrate: int = 9600):
     try:
         ser = serial.Serial(port, baudrate, timeout=1)
-        print(f"[SERIAL] Connected to {port} @ {baudrate}")
+        log.info("[SERIAL] Connected to %s @ %s", port, baudrate)
     except Exception as e:
-        print(f"[SERIAL] Failed to open serial: {e}")
+        log.error("[SERIAL] Failed to open serial: %s", e)
         return
 
     while True:
         try:
-            if ser.in_waiting:
-                cmd = ser.read().decode(errors="ignore").strip().upper()
+            # Block (up to the 1 s timeout) for the next byte, then drain whatever else
+            # has arrived so a burst like "NCCCS" is handled in one pass
+            data = ser.read(ser.in_waiting or 1)
 
+            for cmd in data.decode(errors="ignore").upper():
+                if cmd.isspace():
+                    continue
                 if cmd == "N":
                     create_new_session()
                 elif cmd == "C":
@@ -192,9 +237,9 @@ def serial_worker(port: str, baudrate: int = 9600):
                 elif cmd == "S":
                     end_session()
                 else:
-                    print(f"[SERIAL] Unknown command: {cmd}")
+                    log.warning("[SERIAL] Unknown command: %s", cmd)
         except Exception as e:
-            print(f"[SERIAL] Error: {e}")
+            log.error("[SERIAL] Error: %s", e)
             time.sleep(0.5)
 
 # =========================
@@ -203,15 +248,18 @@ def serial_worker(port: str, baudrate: int = 9600):
 
 def start_fastapi():
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
+    # Single worker (the camera belongs to this process); uvloop/httptools when installed
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto",
+                log_level="warning", access_log=False)
 
 # =========================
 # Main
 # =========================
 
 if __name__ == "__main__":
-    print("[MAIN] Opening camera...")
-    camera_manager.open_camera()
+    log_listener = setup_logging()
+    log.info("[MAIN] Opening camera...")
+    camera_manager.submit(camera_manager.open_camera).result()
 
     serial_thread = threading.Thread(
         target=serial_worker,
@@ -227,11 +275,12 @@ if __name__ == "__main__":
     serial_thread.start()
     api_thread.start()
 
-    print("[MAIN] System running. Ctrl+C to exit.")
+    log.info("[MAIN] System running. Ctrl+C to exit.")
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("\n[MAIN] Shutting down...")
-        camera_manager.close_camera()
+        log.info("[MAIN] Shutting down...")
+        camera_manager.submit(camera_manager.close_camera).result()
+        log_listener.stop()